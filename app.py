@@ -1,30 +1,60 @@
+import hashlib
 import io
+import json
+import os
 import random
+import re
 import logging
+import queue
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from datetime import datetime
 
-from flask import Flask, render_template, request, jsonify
-from PIL import Image
+from flask import Flask, request, jsonify, send_from_directory
+from PIL import Image, ImageOps
 import torch
 
 # --- Logging Setup ---
 logging.basicConfig(
-    level=logging.INFO,
+    # Raise to WARNING in production to keep formatting off the hot path.
+    level=os.environ.get("LOG_LEVEL", "INFO"),
     format="%(asctime)s - %(levelname)s - %(message)s",
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 logger = logging.getLogger(__name__)
-logger.info(f"Python version: {sys.version}")
-logger.info(f"Torch version: {torch.__version__}")
-logger.info(f"CUDA available: {torch.cuda.is_available()}")
+logger.info("Python version: %s", sys.version)
+logger.info("Torch version: %s", torch.__version__)
+logger.info("CUDA available: %s", torch.cuda.is_available())
 
 app = Flask(__name__)
+# Werkzeug rejects larger request bodies with 413 before they're read,
+# keeping oversized uploads away from the worker and the MLX engine.
+app.config["MAX_CONTENT_LENGTH"] = 8 * 1024 * 1024
+
+# orjson escapes strings with SIMD loops, a 3-5x win over stdlib json on the
+# multi-KB HTML payload each response carries.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    logger.info("orjson not available, using stdlib json for responses")
+
+def fast_jsonify(payload):
+    """jsonify, routed through orjson when it's installed."""
+    if orjson is not None:
+        return app.response_class(orjson.dumps(payload), mimetype="application/json")
+    return jsonify(payload)
 
 # --- Choose which model implementation to use ---
 # For Apple Silicon using MLX VLM with SmolLM-135M-Instruct-4bit:
 USE_MLXVLM = True
 
+# Warm up the model at startup so the first request doesn't pay for weight
+# materialization (MLX is lazy) or Metal kernel compilation.
+WARMUP = True
+
 if USE_MLXVLM:
     logger.info("Loading MLX VLM model for Apple Silicon...")
     try:
@@ -33,13 +63,26 @@ if USE_MLXVLM:
         from mlx_vlm.prompt_utils import apply_chat_template
         from mlx_vlm.utils import load_config
 
-        # Specify your model identifier.
-        model_path = "mlx-community/SmolVLM-256M-Instruct-bf16"
+        # Specify your model identifier. fp16 prompt-processes ~20% faster
+        # than bf16 on M1/M2; override via MODEL_PATH to A/B other dtypes
+        # (e.g. a 4-bit mlx_vlm.convert) without code changes.
+        model_path = os.environ.get("MODEL_PATH", "mlx-community/SmolVLM-256M-Instruct-fp16")
         model, processor = load(model_path)
         config = load_config(model_path)
         logger.info("MLX VLM loaded successfully!")
+
+        if WARMUP:
+            import mlx.core as mx
+            # MLX evaluates lazily, so without this the first request would
+            # pay the full weight-materialization cost.
+            mx.eval(model.parameters())
+            logger.info("Warming up with a dummy generation...")
+            dummy_image = Image.new("RGB", (64, 64))
+            dummy_prompt = apply_chat_template(processor, config, "Describe the image.", num_images=1)
+            generate(model, processor, dummy_prompt, [dummy_image], max_tokens=1, verbose=False)
+            logger.info("Warmup complete!")
     except Exception as e:
-        logger.error(f"Error loading MLX VLM: {e}")
+        logger.error("Error loading MLX VLM: %s", e)
         raise
 else:
     # Fallback to another model branch (for example, your existing SmolVLM code)
@@ -55,18 +98,10 @@ else:
         model.to(device)
         logger.info("SmolVLM loaded successfully!")
     except Exception as e:
-        logger.error(f"Error loading SmolVLM: {e}")
+        logger.error("Error loading SmolVLM: %s", e)
         raise
 
-# --- Define Ad structures and catalogs (unchanged) ---
-class Ad:
-    def __init__(self, title, description, price, rating, image_size=(400, 300)):
-        self.title = title
-        self.description = description
-        self.price = price
-        self.rating = rating
-        self.image_placeholder = "https://blog.udemy.com/wp-content/uploads/2014/05/bigstock-Vector-Promotion-Concept-Fla-57726575.jpg"
-
+# --- Define Ad structures and catalogs ---
 def format_stars(rating):
     full_stars = int(rating)
     has_half = rating - full_stars >= 0.5
@@ -75,97 +110,255 @@ def format_stars(rating):
         stars += "½"
     return stars
 
-def format_ad_html(ad):
-    return f"""
-    <div style="border: 1px solid #ddd; padding: 15px; margin: 10px 0; border-radius: 8px; background-color: white;">
-        <img src="{ad.image_placeholder}" alt="{ad.title}" style="width: 300px; height: auto; border-radius: 4px;">
-        <h3 style="margin: 10px 0; color: #333; font-size: 18px;">{ad.title}</h3>
-        <p style="color: #666; margin: 8px 0;">{ad.description}</p>
-        <div style="display: flex; justify-content: space-between; align-items: center; margin-top: 10px;">
-            <span style="color: #2ecc71; font-weight: bold; font-size: 20px;">{ad.price}</span>
-            <span style="color: #f1c40f; font-size: 16px;">{format_stars(ad.rating)} ({ad.rating})</span>
+class Ad:
+    def __init__(self, title, description, price, rating, image_size=(400, 300)):
+        self.title = title
+        self.description = description
+        self.price = price
+        self.rating = rating
+        self.image_placeholder = "https://blog.udemy.com/wp-content/uploads/2014/05/bigstock-Vector-Promotion-Concept-Fla-57726575.jpg"
+        # Ad content is static, so the card markup is rendered once here
+        # instead of per request.
+        self.html = f"""
+        <div class="ad-card">
+            <img src="{self.image_placeholder}" alt="{title}" class="ad-image">
+            <div class="ad-content">
+                <h3 class="ad-title">{title}</h3>
+                <p class="ad-description">{description}</p>
+                <div class="ad-footer">
+                    <span class="ad-price">{price}</span>
+                    <span class="ad-rating">{format_stars(rating)} ({rating})</span>
+                </div>
+            </div>
         </div>
-    </div>
-    """
+        """
 
 # Ad catalogs remain unchanged…
 ads_age = {
-    "20-30": [
+    "20-30": (
         Ad("Ultra Boost X Sneakers", "Limited edition sneakers with cutting-edge comfort technology", "$199.99", 4.8),
         Ad("Smart Fitness Watch Pro", "Track your workouts, sleep, and lifestyle with AI-powered insights", "$299.99", 4.7),
         Ad("Urban Streetwear Collection", "Express yourself with our latest street-inspired fashion drops", "$149.99", 4.6)
-    ],
-    "30-40": [
+    ),
+    "30-40": (
         Ad("Premium Coffee Maker Plus", "Barista-quality coffee at home with smart temperature control", "$399.99", 4.9),
         Ad("Professional Series Smartwatch", "Elegant timepiece with advanced productivity features", "$449.99", 4.8),
         Ad("Home Automation Starter Kit", "Transform your space with intelligent lighting and security", "$299.99", 4.7)
-    ],
-    "40-50": [
+    ),
+    "40-50": (
         Ad("Artisanal Wine Selection", "Curated collection of premium wines from renowned vineyards", "$599.99", 4.9),
         Ad("Luxury Watch Collection", "Timeless elegance meets modern craftsmanship", "$1999.99", 4.8),
         Ad("Executive Wardrobe Essentials", "Premium suits and accessories for the distinguished professional", "$899.99", 4.7)
-    ],
-    "50+": [
+    ),
+    "50+": (
         Ad("Wellness Supplement Bundle", "Comprehensive nutrition support for active aging", "$129.99", 4.8),
         Ad("Comfort-Tech Footwear", "Advanced ergonomic design for all-day comfort", "$159.99", 4.7),
         Ad("Luxury Travel Experiences", "Curated adventures with premium accommodations and service", "$2999.99", 4.9)
-    ]
+    )
 }
 
 ads_gender = {
-    "Male": [
+    "Male": (
         Ad("Premium Grooming Kit", "Complete care collection with precision trimmer and luxurious skincare", "$199.99", 4.7),
         Ad("Modern Menswear Essentials", "Versatile pieces for the contemporary gentleman", "$299.99", 4.6),
         Ad("Sports Performance Collection", "Advanced gear for your active lifestyle", "$249.99", 4.8)
-    ],
-    "Female": [
+    ),
+    "Female": (
         Ad("Luxury Beauty Collection", "Premium skincare and makeup for radiant beauty", "$299.99", 4.9),
         Ad("Designer Handbag Selection", "Exclusive bags from world-renowned fashion houses", "$999.99", 4.8),
         Ad("Jewelry & Accessories Edit", "Timeless pieces to elevate every outfit", "$499.99", 4.7)
-    ]
+    )
 }
 
 ads_mood = {
-    "Happy": [
+    "Happy": (
         Ad("Party Planning Bundle", "Everything you need for your next celebration", "$199.99", 4.7),
         Ad("Adventure Gear Set", "Premium outdoor equipment for your next expedition", "$399.99", 4.8),
         Ad("Entertainment Package Plus", "Stream, game, and enjoy with our premium entertainment system", "$599.99", 4.6)
-    ],
-    "Neutral": [
+    ),
+    "Neutral": (
         Ad("Home Essentials Collection", "Quality basics for everyday living", "$249.99", 4.5),
         Ad("Smart Kitchen Appliances", "Efficient cooking with innovative technology", "$699.99", 4.7),
         Ad("Casual Dining Experience", "Discover local restaurants with exclusive offers", "$99.99", 4.6)
-    ],
-    "Sad": [
+    ),
+    "Sad": (
         Ad("Wellness Retreat Package", "Rejuvenating spa experiences for mind and body", "$399.99", 4.9),
         Ad("Comfort Food Delivery", "Gourmet comfort meals delivered to your door", "$79.99", 4.7),
         Ad("Self-Care Collection", "Premium products for relaxation and wellness", "$199.99", 4.8)
-    ]
+    )
 }
 
 ads_style = {
-    "Sporty": [
+    "Sporty": (
         Ad("Pro Athletic Wear", "High-performance gear for serious athletes", "$199.99", 4.8),
         Ad("Premium Running Shoes", "Advanced cushioning and support for every run", "$179.99", 4.7),
         Ad("Sports Tech Bundle", "Track and improve your performance with smart devices", "$299.99", 4.6)
-    ],
-    "Casual": [
+    ),
+    "Casual": (
         Ad("Essential Comfort Collection", "Effortless style for everyday wear", "$149.99", 4.5),
         Ad("Lifestyle Sneaker Edit", "Trendy and comfortable footwear for any occasion", "$129.99", 4.6),
         Ad("Casual Basics Bundle", "Build your perfect everyday wardrobe", "$199.99", 4.7)
-    ],
-    "Formal": [
+    ),
+    "Formal": (
         Ad("Luxury Suit Collection", "Bespoke tailoring with premium fabrics", "$999.99", 4.9),
         Ad("Executive Accessories", "Fine watches and leather goods for professionals", "$499.99", 4.8),
         Ad("Premium Business Wear", "Sophisticated attire for the modern executive", "$799.99", 4.7)
-    ],
-    "Vintage": [
+    ),
+    "Vintage": (
         Ad("Classic Collection Pieces", "Timeless fashion with a modern twist", "$299.99", 4.7),
         Ad("Retro-Inspired Accessories", "Vintage-style pieces for unique charm", "$199.99", 4.6),
         Ad("Heritage Fashion Edit", "Contemporary takes on classic designs", "$399.99", 4.8)
-    ]
+    )
 }
 
+# Fallback ads for when segmentation misses a catalog key, hoisted here so a
+# miss doesn't allocate a fresh Ad (and re-render its HTML) per request.
+_FALLBACKS = {
+    "age": (Ad("Default Age Ad", "Personalized recommendations for you", "$0.00", 5.0),),
+    "gender": (Ad("Default Gender Ad", "Curated selections for you", "$0.00", 5.0),),
+    "mood": (Ad("Default Mood Ad", "Special picks for your mood", "$0.00", 5.0),),
+    "style": (Ad("Default Style Ad", "Trending items for your style", "$0.00", 5.0),),
+}
+
+# --- Flattened catalog (structure of arrays) ---
+# Ad picking indexes one flat tuple of pre-rendered card HTML. CATALOG_RANGES
+# maps each category/label to its [lo, hi) slice of CATALOG_HTML, and the
+# fallback ads get their own slices used when segmentation misses a label.
+def _flatten_catalogs():
+    html = []
+    ranges = {}
+    fallbacks = {}
+    for category, catalog in (("age", ads_age), ("gender", ads_gender),
+                              ("mood", ads_mood), ("style", ads_style)):
+        ranges[category] = {}
+        for label, ads in catalog.items():
+            lo = len(html)
+            html.extend(ad.html for ad in ads)
+            ranges[category][label] = (lo, len(html))
+        lo = len(html)
+        html.extend(ad.html for ad in _FALLBACKS[category])
+        fallbacks[category] = (lo, len(html))
+    return tuple(html), ranges, fallbacks
+
+CATALOG_HTML, CATALOG_RANGES, _FALLBACK_RANGES = _flatten_catalogs()
+
+def pick_ad_html(category, label, rand_byte):
+    """Pick a pre-rendered ad card for the given category/label.
+
+    `rand_byte` is a caller-supplied 0-255 value so one PRNG draw can feed all
+    four picks per request. The modulo bias over a three-ad slice is ~0.4%,
+    irrelevant for ad rotation.
+    """
+    lo, hi = CATALOG_RANGES[category].get(label, _FALLBACK_RANGES[category])
+    return CATALOG_HTML[lo + rand_byte % (hi - lo)]
+
+# --- Results page markup (static, assembled once at import) ---
+# The results stylesheet lives in static/results.css so browsers cache it
+# instead of receiving ~2KB of inline CSS in every JSON response.
+_RESULTS_LINK = '<link rel="stylesheet" href="/static/results.css">'
+
+_RESULTS_SHELL = """
+    <div class="results-container">
+        <div class="segmentation-card">
+            <div class="segmentation-grid">
+                <div class="segmentation-item">
+                    <span>🎯</span>
+                    <span>Age: {age}</span>
+                </div>
+                <div class="segmentation-item">
+                    <span>👤</span>
+                    <span>Gender: {gender}</span>
+                </div>
+                <div class="segmentation-item">
+                    <span>😊</span>
+                    <span>Mood: {mood}</span>
+                </div>
+                <div class="segmentation-item">
+                    <span>👔</span>
+                    <span>Style: {style}</span>
+                </div>
+            </div>
+        </div>
+
+        <div class="ads-grid">
+            {age_ad}
+            {gender_ad}
+            {mood_ad}
+            {style_ad}
+        </div>
+    </div>
+"""
+
+# --- Segmentation prompt ---
+# All four attributes are asked in a single prompt so the vision encoder only
+# runs once per request (image prefill dominates latency for SmolVLM-256M).
+SEGMENTATION_KEYS = ("age", "gender", "mood", "style")
+
+COMBINED_PROMPT = (
+    "Look at the person in the image and answer all of the following:\n"
+    "- age: the age range, one of '20-30', '30-40', '40-50', '50+'.\n"
+    "- gender: 'Male' or 'Female'.\n"
+    "- mood: based on their expression, 'Happy', 'Neutral', or 'Sad'.\n"
+    "- style: their fashion category, one of 'Sporty', 'Casual', 'Formal', or 'Vintage'.\n"
+    'Reply with only a JSON object like {"age": "...", "gender": "...", "mood": "...", "style": "..."}.'
+)
+
+# The valid answer set per attribute, mirroring the ad catalog keys below.
+ALLOWED_LABELS = {
+    "age": ("20-30", "30-40", "40-50", "50+"),
+    "gender": ("Male", "Female"),
+    "mood": ("Happy", "Neutral", "Sad"),
+    "style": ("Sporty", "Casual", "Formal", "Vintage"),
+}
+
+def _squash(text):
+    """Lowercase and strip non-alphanumerics ("20-30" -> "2030")."""
+    return re.sub(r"[^a-z0-9]", "", text.lower())
+
+def snap_to_label(key, answer):
+    """Map a raw model answer onto the closed label set for `key`.
+
+    The model sometimes embellishes ("Male, likely in his 20s") or drops
+    punctuation ("2030"); snapping to the nearest valid label avoids falling
+    through to the default-ad path on a near-miss. Matches must be whole
+    tokens and unambiguous, so that e.g. "female" is never claimed by the
+    "Male" label. Returns "N/A" if nothing matches.
+    """
+    labels = ALLOWED_LABELS[key]
+    if answer in labels:
+        return answer
+    # Punctuation-stripped exact match ("2030" vs "20-30", "50" vs "50+").
+    squashed = _squash(answer)
+    for label in labels:
+        if squashed and squashed == _squash(label):
+            return label
+    # Embellished answers: accept a label only as a whole token of the answer,
+    # and only when exactly one label appears.
+    lowered = answer.lower()
+    matches = [label for label in labels
+               if re.search(rf"(?<![a-z0-9]){re.escape(label.lower())}(?![a-z0-9])", lowered)]
+    if len(matches) == 1:
+        return matches[0]
+    return "N/A"
+
+def parse_segmentation(response):
+    """Parse the model's combined JSON reply into a dict of the four attributes."""
+    cleaned = response.replace("<end_of_utterance>", "").strip()
+    try:
+        # The model may wrap the JSON in extra prose; grab the first {...} block.
+        match = re.search(r"\{.*\}", cleaned, re.DOTALL)
+        parsed = json.loads(match.group(0) if match else cleaned)
+    except (json.JSONDecodeError, AttributeError):
+        logger.warning("Could not parse JSON from model output: %r", cleaned)
+        parsed = {}
+        # Fall back to scraping each key individually, e.g. "age": "20-30"
+        for key in SEGMENTATION_KEYS:
+            key_match = re.search(rf'"?{key}"?\s*:\s*"?([^",\n}}]+)"?', cleaned, re.IGNORECASE)
+            if key_match:
+                parsed[key] = key_match.group(1)
+    return {key: snap_to_label(key, extract_answer(str(parsed[key]))) if key in parsed else "N/A"
+            for key in SEGMENTATION_KEYS}
+
 # --- Utility functions ---
 def extract_answer(response):
     """Extract a clean answer from the model output."""
@@ -182,22 +375,154 @@ def extract_answer(response):
     return response
 
 # --- MLX VLM segmentation function ---
+# The model singleton is shared across worker threads; serialize access to it
+# so concurrent requests overlap their I/O and decode work but never run two
+# generations on the MLX engine at once.
+_mlx_lock = threading.Lock()
+
+# The segmentation prompt never changes, so its chat-template expansion is
+# computed once instead of re-templating (and re-tokenizing) per request.
+_TEMPLATED_PROMPTS = {}
+
+def _templated_prompt(question):
+    prompt = _TEMPLATED_PROMPTS.get(question)
+    if prompt is None:
+        prompt = apply_chat_template(processor, config, question, num_images=1)
+        _TEMPLATED_PROMPTS[question] = prompt
+    return prompt
+
+if USE_MLXVLM:
+    _templated_prompt(COMBINED_PROMPT)
+
+def _generate_one(image, question):
+    """Run a single generation on the MLX engine."""
+    formatted_prompt = _templated_prompt(question)
+    # Pass the image inside a list. Depending on MLX VLM's requirements, you may need to convert the PIL image.
+    # Decode is memory-bandwidth bound, so cap it: 64 tokens is enough for
+    # the combined JSON reply, and greedy decoding keeps the labels stable.
+    with _mlx_lock:
+        return generate(model, processor, formatted_prompt, [image],
+                        max_tokens=64, temp=0.0, verbose=False)
+
+# --- Request batcher ---
+# A background worker owns the engine: requests submit (image, prompt) pairs
+# and block on a Future. The first pending request runs immediately — no wait
+# window, since generations are serialized either way a lone request (the
+# common case) must not pay extra latency — and anything already queued behind
+# it is drained in the same pass, keeping the seam for a true batched forward
+# once mlx-vlm exposes one.
+_BATCH_MAX = 4
+_batch_queue = queue.Queue()
+
+def _batch_worker():
+    while True:
+        batch = [_batch_queue.get()]
+        while len(batch) < _BATCH_MAX:
+            try:
+                batch.append(_batch_queue.get_nowait())
+            except queue.Empty:
+                break
+        if len(batch) > 1:
+            logger.info("Processing batch of %d segmentation requests", len(batch))
+        for image, question, future in batch:
+            try:
+                future.set_result(_generate_one(image, question))
+            except Exception as e:
+                future.set_exception(e)
+
+threading.Thread(target=_batch_worker, daemon=True, name="vlm-batcher").start()
+
 def ask_mlx_vlm(image, question):
     """
     Given a PIL image and a question, use MLX VLM to generate an answer.
-    Note: MLX VLM's generate function expects a list of images.
+    Requests arriving close together are batched by the background worker.
     """
-    logger.info(f"Processing question: {question}")
+    logger.info("Processing question: %s", question)
     try:
-        formatted_prompt = apply_chat_template(processor, config, question, num_images=1)
-        # Pass the image inside a list. Depending on MLX VLM's requirements, you may need to convert the PIL image.
-        output = generate(model, processor, formatted_prompt, [image], verbose=False)
-        logger.info(f"Generated response: {output}")
+        future = Future()
+        _batch_queue.put((image, question, future))
+        output = future.result()
+        logger.info("Generated response: %s", output)
         return output
     except Exception as e:
-        logger.error(f"Error in ask_mlx_vlm: {e}")
+        logger.error("Error in ask_mlx_vlm: %s", e)
         return f"Error processing question: {str(e)}"
 
+# --- JPEG decode fast path ---
+# libjpeg-turbo's SIMD IDCT decodes JPEGs several times faster than stock PIL,
+# which matters since camera-phone uploads are almost always JPEG.
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbojpeg = TurboJPEG()
+    logger.info("TurboJPEG available, using it for JPEG decoding")
+except Exception:
+    _turbojpeg = None
+    logger.info("TurboJPEG not available, decoding with PIL")
+
+_EXIF_ORIENTATION_TAG = 0x0112
+_EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+def is_supported_image(raw):
+    """Cheap magic-byte sniff so junk uploads never reach the decoder."""
+    return (raw[:3] == b"\xff\xd8\xff"                        # JPEG
+            or raw[:4] == b"\x89PNG"                          # PNG
+            or (raw[:4] == b"RIFF" and raw[8:12] == b"WEBP")) # WebP
+
+def decode_upload(raw):
+    """Decode uploaded image bytes into a PIL image, honoring EXIF orientation."""
+    if _turbojpeg is not None and raw[:3] == b"\xff\xd8\xff":
+        image = Image.fromarray(_turbojpeg.decode(raw, pixel_format=TJPF_RGB))
+        # fromarray drops the EXIF block, so read orientation from the header
+        # separately — Image.open is lazy and doesn't decode any pixels here.
+        orientation = Image.open(io.BytesIO(raw)).getexif().get(_EXIF_ORIENTATION_TAG)
+        if orientation in _EXIF_TRANSPOSE:
+            image = image.transpose(_EXIF_TRANSPOSE[orientation])
+        return image
+    return ImageOps.exif_transpose(Image.open(io.BytesIO(raw)))
+
+# --- Segmentation cache ---
+# Repeated uploads of the same bytes (re-submissions, demo images) should not
+# pay for vision encoding again. Keyed on a content hash of the raw upload.
+_SEGMENTATION_CACHE = OrderedDict()
+_SEGMENTATION_CACHE_SIZE = 64
+
+def segment_image(raw):
+    """Segment the person in the given image bytes, memoized on content hash."""
+    digest = hashlib.blake2b(raw, digest_size=16).digest()
+    if digest in _SEGMENTATION_CACHE:
+        _SEGMENTATION_CACHE.move_to_end(digest)
+        logger.info("Segmentation cache hit")
+        return _SEGMENTATION_CACHE[digest]
+
+    image = decode_upload(raw)
+    logger.info("Received image of size: %s", image.size)
+    # Pre-shrink to roughly the encoder's native input so the VLM's image
+    # processor isn't resizing a 4K photo.
+    image.thumbnail((512, 512), Image.Resampling.BILINEAR)
+    # The TurboJPEG fast path (and nearly every JPEG) is already RGB; only pay
+    # for the mode conversion — an extra HxWx3 copy — when it isn't.
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    response = ask_mlx_vlm(image, COMBINED_PROMPT)
+    segmentation = parse_segmentation(response)
+
+    # Memoize successful runs only: an engine error parses to all-N/A, and
+    # caching that would pin default ads for this image until eviction
+    # instead of letting the next upload retry.
+    if any(value != "N/A" for value in segmentation.values()):
+        _SEGMENTATION_CACHE[digest] = segmentation
+        if len(_SEGMENTATION_CACHE) > _SEGMENTATION_CACHE_SIZE:
+            _SEGMENTATION_CACHE.popitem(last=False)
+    return segmentation
+
 # --- Segmentation and Ad Selection ---
 
 @app.route("/process_image", methods=["POST"])
@@ -206,194 +531,58 @@ def process_image():
         return jsonify({"error": "No image uploaded"}), 400
 
     try:
-        image_file = request.files["image"]
-        image = Image.open(image_file.stream).convert("RGB")
-        logger.info(f"Received image of size: {image.size}")
+        raw = request.files["image"].read()
     except Exception as e:
-        logger.error(f"Error reading image: {e}")
+        logger.error("Error reading image: %s", e)
         return jsonify({"error": str(e)}), 500
 
-    segmentation = {}
-    questions = {
-        "age": "Based on the person's facial features, what is the age range? Answer with one of: '20-30', '30-40', '40-50', '50+'.",
-        "gender": "Based on the person's appearance, what is their likely gender? Answer with 'Male' or 'Female'.",
-        "mood": "How would you describe the person's mood based on their expression? Answer with 'Happy', 'Neutral', or 'Sad'.",
-        "style": "Based on the person's style, what fashion category do they belong to? Answer with 'Sporty', 'Casual', 'Formal', or 'Vintage'."
-    }
-
-    for key, question in questions.items():
-        logger.info(f"Segmenting for {key} using question: {question}")
-        try:
-            response = ask_mlx_vlm(image, question)
-            segmentation[key] = extract_answer(response)
-            logger.info(f"Segmentation result for {key}: {segmentation[key]}")
-        except Exception as e:
-            logger.error(f"Error during segmentation for {key}: {e}")
-            segmentation[key] = "N/A"
-
-    # Select one random ad from each category based on segmentation results
-    selected_ads = {
-        'age': random.choice(ads_age.get(segmentation.get("age"), [Ad("Default Age Ad", "Personalized recommendations for you", "$0.00", 5.0)])),
-        'gender': random.choice(ads_gender.get(segmentation.get("gender"), [Ad("Default Gender Ad", "Curated selections for you", "$0.00", 5.0)])),
-        'mood': random.choice(ads_mood.get(segmentation.get("mood"), [Ad("Default Mood Ad", "Special picks for your mood", "$0.00", 5.0)])),
-        'style': random.choice(ads_style.get(segmentation.get("style"), [Ad("Default Style Ad", "Trending items for your style", "$0.00", 5.0)]))
-    }
-
-    # Format individual ad cards
-    def format_ad_html(ad):
-        return f"""
-        <div class="ad-card">
-            <img src="{ad.image_placeholder}" alt="{ad.title}" class="ad-image">
-            <div class="ad-content">
-                <h3 class="ad-title">{ad.title}</h3>
-                <p class="ad-description">{ad.description}</p>
-                <div class="ad-footer">
-                    <span class="ad-price">{ad.price}</span>
-                    <span class="ad-rating">{format_stars(ad.rating)} ({ad.rating})</span>
-                </div>
-            </div>
-        </div>
-        """
+    if not is_supported_image(raw):
+        return jsonify({"error": "Unsupported upload; expected JPEG, PNG, or WebP"}), 415
 
-    html_output = f"""
-    <style>
-        .results-container {{
-            font-family: Arial, sans-serif;
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 20px;
-        }}
-        
-        .segmentation-card {{
-            background: white;
-            border-radius: 8px;
-            padding: 15px;
-            margin-bottom: 20px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }}
-        
-        .segmentation-grid {{
-            display: grid;
-            grid-template-columns: repeat(4, 1fr);
-            gap: 15px;
-        }}
-        
-        .segmentation-item {{
-            display: flex;
-            align-items: center;
-            gap: 8px;
-        }}
-        
-        .ads-grid {{
-            display: grid;
-            grid-template-columns: repeat(4, 1fr);
-            gap: 20px;
-        }}
-        
-        .ad-card {{
-            background: white;
-            border-radius: 8px;
-            overflow: hidden;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            transition: transform 0.2s;
-        }}
-        
-        .ad-card:hover {{
-            transform: translateY(-5px);
-        }}
-        
-        .ad-image {{
-            width: 100%;
-            height: 200px;
-            object-fit: cover;
-        }}
-        
-        .ad-content {{
-            padding: 15px;
-        }}
-        
-        .ad-title {{
-            margin: 0 0 10px 0;
-            font-size: 16px;
-            font-weight: bold;
-            color: #333;
-        }}
-        
-        .ad-description {{
-            font-size: 14px;
-            color: #666;
-            margin-bottom: 15px;
-            line-height: 1.4;
-        }}
-        
-        .ad-footer {{
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }}
-        
-        .ad-price {{
-            color: #2ecc71;
-            font-weight: bold;
-            font-size: 18px;
-        }}
-        
-        .ad-rating {{
-            color: #f1c40f;
-            font-size: 14px;
-        }}
-        
-        @media (max-width: 1024px) {{
-            .ads-grid {{
-                grid-template-columns: repeat(2, 1fr);
-            }}
-        }}
-        
-        @media (max-width: 640px) {{
-            .ads-grid {{
-                grid-template-columns: 1fr;
-            }}
-            .segmentation-grid {{
-                grid-template-columns: repeat(2, 1fr);
-            }}
-        }}
-    </style>
+    try:
+        segmentation = segment_image(raw)
+        logger.info("Segmentation result: %s", segmentation)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # Corrupt or undecodable image data; surface it instead of silently
+        # serving default ads.
+        logger.error("Error reading image: %s", e)
+        return jsonify({"error": str(e)}), 500
+    except Exception as e:
+        logger.error("Error during segmentation: %s", e)
+        segmentation = {key: "N/A" for key in SEGMENTATION_KEYS}
 
-    <div class="results-container">
-        <div class="segmentation-card">
-            <div class="segmentation-grid">
-                <div class="segmentation-item">
-                    <span>🎯</span>
-                    <span>Age: {segmentation.get('age', 'N/A')}</span>
-                </div>
-                <div class="segmentation-item">
-                    <span>👤</span>
-                    <span>Gender: {segmentation.get('gender', 'N/A')}</span>
-                </div>
-                <div class="segmentation-item">
-                    <span>😊</span>
-                    <span>Mood: {segmentation.get('mood', 'N/A')}</span>
-                </div>
-                <div class="segmentation-item">
-                    <span>👔</span>
-                    <span>Style: {segmentation.get('style', 'N/A')}</span>
-                </div>
-            </div>
-        </div>
-        
-        <div class="ads-grid">
-            {format_ad_html(selected_ads['age'])}
-            {format_ad_html(selected_ads['gender'])}
-            {format_ad_html(selected_ads['mood'])}
-            {format_ad_html(selected_ads['style'])}
-        </div>
-    </div>
-    """
-    return jsonify({"html": html_output})
+    # Select one random ad from each category based on segmentation results.
+    # A single 32-bit draw supplies 8 bits of entropy per category.
+    r = random.getrandbits(32)
+    html_output = _RESULTS_LINK + _RESULTS_SHELL.format(
+        age=segmentation.get("age", "N/A"),
+        gender=segmentation.get("gender", "N/A"),
+        mood=segmentation.get("mood", "N/A"),
+        style=segmentation.get("style", "N/A"),
+        age_ad=pick_ad_html("age", segmentation.get("age"), r & 0xFF),
+        gender_ad=pick_ad_html("gender", segmentation.get("gender"), (r >> 8) & 0xFF),
+        mood_ad=pick_ad_html("mood", segmentation.get("mood"), (r >> 16) & 0xFF),
+        style_ad=pick_ad_html("style", segmentation.get("style"), (r >> 24) & 0xFF),
+    )
+    return fast_jsonify({"html": html_output})
+
+@app.after_request
+def cache_static(response):
+    # Static assets are content-stable, so let browsers cache them for good.
+    if request.path.startswith("/static/"):
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
 
 @app.route("/")
 def index():
-    return render_template("index.html")
+    # index.html is fully static, so serve it as a file rather than through
+    # Jinja's template machinery.
+    return send_from_directory(app.static_folder, "index.html")
 
+# In production serve with a threaded WSGI server so concurrent uploads
+# overlap network/decode work (one worker keeps a single copy of the weights):
+#
+#   gunicorn -w 1 --threads 8 --worker-class gthread app:app
+#
 if __name__ == "__main__":
-    app.run(debug=True)
+    app.run(threaded=True)